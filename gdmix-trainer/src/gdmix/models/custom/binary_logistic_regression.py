@@ -1,9 +1,17 @@
+import logging
+
 import numpy as np
 import scipy.sparse
 from scipy.optimize import fmin_l_bfgs_b
 from scipy.special import expit
 from sklearn import metrics
 
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+# Default projected gradient tolerance of scipy's fmin_l_bfgs_b
+_DEFAULT_PGTOL = 1e-5
+
 
 class BinaryLogisticRegressionTrainer:
     """
@@ -65,18 +73,34 @@ class BinaryLogisticRegressionTrainer:
 
     def _get_loss_from_regularization(self, theta, intercept_index=0):
         """
-        Get loss for regularization term. Exclude intercept if self.regularize_bias is set to false
+        Get loss for regularization term. Exclude intercept if self.regularize_bias is set to false.
+        "intercept_index" is an array of indices when several models are stacked in one problem.
         """
-        # For now, we assume "intercept_index" is always zero
         if not self.regularize_bias:
-            loss = (self.lambda_l2 / 2.0) * theta[intercept_index + 1:].dot(theta[intercept_index + 1:])
+            if np.isscalar(intercept_index):
+                # Single model, the intercept is the first coefficient. Slicing avoids copying theta.
+                loss = (self.lambda_l2 / 2.0) * theta[intercept_index + 1:].dot(theta[intercept_index + 1:])
+            else:
+                intercepts = theta[intercept_index]
+                loss = (self.lambda_l2 / 2.0) * (theta.dot(theta) - intercepts.dot(intercepts))
         else:
             loss = (self.lambda_l2 / 2.0) * theta.dot(theta)
         return loss
 
-    def _loss(self, theta, X, y, weights, offsets):
+    def _get_gradient_from_regularization(self, theta, intercept_index=0):
         """
-        Calculate loss for weighted binary logistic regression
+        Get gradient for regularization term. Exclude intercept if self.regularize_bias is set to false.
+        "intercept_index" is an array of indices when several models are stacked in one problem.
+        """
+        gradient = self.lambda_l2 * theta
+        if not self.regularize_bias:
+            gradient[intercept_index] = 0
+        return gradient
+
+    def _loss_and_gradient(self, theta, X, y, weights, offsets, intercept_index=0):
+        """
+        Calculate loss and its gradient for weighted binary logistic regression.
+        Both share the logits and exp(-|logits|), so they are computed together in one pass over X per L-BFGS call.
         """
         n_samples = self._get_number_of_samples(X)
 
@@ -93,35 +117,21 @@ class BinaryLogisticRegressionTrainer:
         # max(x, 0) - x * z + log(1 + exp(-abs(x)))
 
         pred = X.dot(theta) + offsets
-        cross_entropy_cost = np.maximum(pred, 0) - pred * y + np.log(1 + np.exp(-np.absolute(pred)))
+        exp_neg_abs_pred = np.exp(-np.absolute(pred))
+        cross_entropy_cost = np.maximum(pred, 0) - pred * y + np.log(1 + exp_neg_abs_pred)
 
         cost = weights * cross_entropy_cost
 
         # Compute total cost, including regularization
-        total_cost = (1.0 / n_samples) * (cost.sum() + self._get_loss_from_regularization(theta))
-
-        return total_cost
-
-    def _get_gradient_from_regularization(self, theta, intercept_index=0):
-        """
-        Get gradient for regularization term. Exclude intercept if self.regularize_bias is set to false
-        """
-        gradient = self.lambda_l2 * theta
-        if not self.regularize_bias:
-            gradient[intercept_index] = 0
-        return gradient
+        total_cost = (1.0 / n_samples) * (cost.sum() + self._get_loss_from_regularization(theta, intercept_index))
 
-    def _gradient(self, theta, X, y, weights, offsets):
-        """
-        Calculate gradient of loss for weighted binary logistic regression
-        """
-        n_samples = self._get_number_of_samples(X)
-        predictions = self._predict(theta, X, offsets)
+        # Stable sigmoid from the same exponential: 1 / (1 + exp(-x)) for x >= 0, exp(x) / (1 + exp(x)) otherwise
+        predictions = np.where(pred >= 0, 1.0, exp_neg_abs_pred) / (1 + exp_neg_abs_pred)
 
         cost_grad = X.T.dot(weights * (predictions - y))
 
-        grad = (1.0 / n_samples) * (cost_grad + self._get_gradient_from_regularization(theta))
-        return grad
+        grad = (1.0 / n_samples) * (cost_grad + self._get_gradient_from_regularization(theta, intercept_index))
+        return total_cost, grad
 
     def _add_column_of_ones(self, X):
         """
@@ -130,10 +140,10 @@ class BinaryLogisticRegressionTrainer:
         if isinstance(X, np.ndarray):
             X_with_intercept = np.hstack((np.ones((X.shape[0], 1)), X))
         else:
-            X_with_intercept = scipy.sparse.hstack((np.ones((X.shape[0], 1)), X))
+            X_with_intercept = scipy.sparse.hstack((np.ones((X.shape[0], 1)), X), format='csr')
         return X_with_intercept
 
-    def fit(self, X, y, weights=None, offsets=None, theta_initial=None):
+    def fit(self, X, y, weights=None, offsets=None, theta_initial=None, precision=None, max_iter=None):
         """
         Fit a binary logistic regression model
         :param X:               a dense or sparse matrix of dimensions (n x d), where n is the number of samples,
@@ -142,9 +152,91 @@ class BinaryLogisticRegressionTrainer:
         :param weights:         vector of sample weights; of dimensions (n x 1)  where n is the number of samples
         :param offsets:         vector of sample offsets; of dimensions (n x 1)  where n is the number of samples
         :param theta_initial:   initial value for the coefficients, useful in warm start.
+        :param precision:       optional override of the L-BFGS precision set at construction time.
+        :param max_iter:        optional override of the maximum number of L-BFGS iterations set at construction time.
         :return:    training results dictionary, including learned parameters
         """
 
+        weights, offsets = self._check_training_data(X, y, weights, offsets)
+        X_with_intercept = self._add_column_of_ones(X)
+        if theta_initial is None:
+            theta_initial = np.zeros(X_with_intercept.shape[1])
+
+        assert theta_initial.shape == (X_with_intercept.shape[1],), "Initial model should have the same shape as input data"
+        # Run minimization
+        result = self._minimize(X_with_intercept, y, weights, offsets, theta_initial, precision, max_iter)
+        # Extract learned parameters from result
+        self.theta = result[0]
+
+        return result
+
+    def fit_batch(self, Xs, ys, weights=None, offsets=None, thetas_initial=None, precision=None, max_iter=None):
+        """
+        Fit several independent binary logistic regression models with a single L-BFGS solve.
+        The models are stacked into one block-diagonal problem where each block keeps its own intercept. The blocks
+        share no coefficients, so the optimum of the stacked problem is the optimum of every model, while the solver
+        setup and callback overhead is paid once for the whole batch instead of once per model.
+        The stacked solve needs more iterations than any single model, so the iteration cap is scaled by the number of
+        models. Its stopping tests also apply to the whole batch, so every model whose own gradient is still above the
+        tolerance afterwards is refined alone, starting from the batched solution, with the stopping criteria of fit().
+        :param Xs:              list of dense or sparse matrices, one (n_i x d_i) matrix per model
+        :param ys:              list of binary label vectors, one per model
+        :param weights:         optional list of sample weight vectors, one per model
+        :param offsets:         optional list of sample offset vectors, one per model
+        :param thetas_initial:  optional list of initial coefficients, one per model. None entries start from zeros.
+        :param precision:       optional override of the L-BFGS precision set at construction time.
+        :param max_iter:        optional override of the maximum number of L-BFGS iterations per model set at construction time.
+        :return:    list of learned coefficients, one per model, intercept first
+        """
+        num_models = len(Xs)
+        weights = [None] * num_models if weights is None else weights
+        offsets = [None] * num_models if offsets is None else offsets
+        thetas_initial = [None] * num_models if thetas_initial is None else thetas_initial
+        weights, offsets = zip(*(self._check_training_data(X, y, w, o) for X, y, w, o in zip(Xs, ys, weights, offsets)))
+        max_iter = self.max_iter if max_iter is None else max_iter
+
+        Xs_with_intercept = [self._add_column_of_ones(X) for X in Xs]
+        dims = [X.shape[1] for X in Xs_with_intercept]
+        intercept_indices = np.cumsum([0] + dims[:-1])
+        theta_initial = np.concatenate([np.zeros(d) if t is None else t for d, t in zip(dims, thetas_initial)])
+        # The stacked loss is averaged over all samples, which scales the gradient of each block by n_i / n.
+        # Tighten the projected gradient tolerance accordingly so every block converges at least as far as in fit().
+        num_samples = [self._get_number_of_samples(X) for X in Xs]
+        pgtol = _DEFAULT_PGTOL * min(num_samples) / sum(num_samples)
+        assert theta_initial.shape == (sum(dims),), "Initial models should have the same shape as input data"
+
+        # Run minimization on the block-diagonal problem
+        result = self._minimize(scipy.sparse.block_diag(Xs_with_intercept, format='csr'), np.concatenate(ys), np.concatenate(weights),
+                                np.concatenate(offsets), theta_initial, precision, max_iter * num_models, intercept_indices, pgtol)
+        if result[2]['warnflag']:
+            logger.warning(f"Batched L-BFGS solve of {num_models} models stopped early: {result[2]['task']!r}. "
+                           f"Unconverged models are refined one by one.")
+
+        thetas = np.split(result[0], intercept_indices[1:])
+        for i, (X, y, w, o) in enumerate(zip(Xs_with_intercept, ys, weights, offsets)):
+            _, gradient = self._loss_and_gradient(thetas[i], X, y, w, o)
+            if np.abs(gradient).max() > _DEFAULT_PGTOL:
+                thetas[i] = self._minimize(X, y, w, o, thetas[i], precision, max_iter)[0]
+        return thetas
+
+    def _minimize(self, X_with_intercept, y, weights, offsets, theta_initial, precision, max_iter, intercept_index=0, pgtol=_DEFAULT_PGTOL):
+        """
+        Run L-BFGS on the loss of one model, or of several models stacked along the block diagonal of X_with_intercept
+        """
+        return fmin_l_bfgs_b(func=self._loss_and_gradient,
+                             x0=theta_initial,
+                             approx_grad=False,
+                             m=self.num_lbfgs_corrections,
+                             factr=self.precision if precision is None else precision,
+                             maxiter=self.max_iter if max_iter is None else max_iter,
+                             args=(X_with_intercept, y, weights, offsets, intercept_index),
+                             pgtol=pgtol,
+                             disp=0)
+
+    def _check_training_data(self, X, y, weights, offsets):
+        """
+        Validate the labels and shapes of a training dataset, fill in default weights and offsets
+        """
         # Assert labels are of binary type only
         assert np.count_nonzero((y != 0) & (y != 1)) == 0
 
@@ -156,26 +248,7 @@ class BinaryLogisticRegressionTrainer:
 
         # Assert all shapes are same
         assert (X.shape[0] == y.shape[0] == weights.shape[0] == offsets.shape[0])
-
-        X_with_intercept = self._add_column_of_ones(X)
-        if theta_initial is None:
-            theta_initial = np.zeros(X_with_intercept.shape[1])
-
-        assert theta_initial.shape == (X_with_intercept.shape[1],), "Initial model should have the same shape as input data"
-        # Run minimization
-        result = fmin_l_bfgs_b(func=self._loss,
-                               x0=theta_initial,
-                               approx_grad=False,
-                               fprime=self._gradient,
-                               m=self.num_lbfgs_corrections,
-                               factr=self.precision,
-                               maxiter=self.max_iter,
-                               args=(X_with_intercept, y, weights, offsets),
-                               disp=0)
-        # Extract learned parameters from result
-        self.theta = result[0]
-
-        return result
+        return weights, offsets
 
     def predict_proba(self, X, offsets=None, custom_theta=None, return_logits=False):
         """
@@ -4,6 +4,8 @@ import logging
 import os
 from functools import partial
 from multiprocessing import Pool, current_process
+from multiprocessing.pool import ThreadPool
+from threading import current_thread
 from typing import Optional
 
 import fastavro
@@ -16,7 +18,8 @@ from gdmix.io.input_data_pipeline import per_entity_grouped_input_fn
 from gdmix.models.api import Model
 from gdmix.models.custom.base_lr_params import LRParams
 from gdmix.models.custom.binary_logistic_regression import BinaryLogisticRegressionTrainer
-from gdmix.models.custom.scipy.job_consumers import InferenceJobConsumer, TrainingJobConsumer, TrainingResult, prepare_jobs
+from gdmix.models.custom.scipy.job_consumers import BatchedTrainingJobConsumer, InferenceJobConsumer, ThreadLocalConsumer, TrainingJobConsumer, \
+    TrainingResult, batch_small_jobs, prepare_jobs
 from gdmix.util import constants
 from gdmix.util.io_utils import read_json_file, export_linear_model_to_avro, get_feature_map, batched_write_avro, \
     get_inference_output_avro_schema, INTERCEPT
@@ -38,9 +41,12 @@ class REParams(LRParams):
     max_training_queue_size: int = 10  # Maximum size of training job queue
     training_queue_timeout_in_seconds: int = 300  # Training queue put timeout in seconds.
     num_of_consumers: int = 2  # Number of consumer processes that will train RE models in parallel.
+    use_thread_pool: bool = False  # Run consumers as threads instead of processes, jobs are then passed by reference instead of pickled.
+    training_job_batch_size: int = 1  # Number of small entities trained together in one block-diagonal LBFGS solve, 1 disables batching.
 
     def __post_init__(self):
         assert self.max_training_queue_size > self.num_of_consumers, "queue size limit must be larger than the number of consumers"
+        assert self.training_job_batch_size > 0, "training job batch size must be a positive number"
 
 
 class RandomEffectLRLBFGSModel(Model):
@@ -85,7 +91,13 @@ class RandomEffectLRLBFGSModel(Model):
         logger.info(f"Found {num_features} features in feature bag {self.feature_bag_name}")
         assert num_features > 0, "number of features must > 0"
 
-        with Pool(self.model_params.num_of_consumers, initializer=lambda: logger.info(f"Process {current_process()} ready to work!")) as pool:
+        # Threads share the jobs with the producer without pickling them, the LR solvers spend most of their time in numpy/scipy
+        # calls that release the GIL.
+        if self.model_params.use_thread_pool:
+            pool = ThreadPool(self.model_params.num_of_consumers, initializer=lambda: logger.info(f"Thread {current_thread().name} ready to work!"))
+        else:
+            pool = Pool(self.model_params.num_of_consumers, initializer=lambda: logger.info(f"Process {current_process()} ready to work!"))
+        with pool:
             avro_filename = f"part-{partition_index:05d}.avro"
             if action == constants.ACTION_INFERENCE:
                 output_dir, input_data_path = action_context
@@ -124,9 +136,16 @@ class RandomEffectLRLBFGSModel(Model):
                                                    precision=self.model_params.lbfgs_tolerance / np.finfo(float).eps,
                                                    num_lbfgs_corrections=self.model_params.num_of_lbfgs_curvature_pairs,
                                                    max_iter=self.model_params.num_of_lbfgs_iterations)
-        consumer = TrainingJobConsumer(lr_model, name=input_path)
-        results = self._pooled_action(pool, consumer, input_path, schema_params, model_weights, num_features, metadata_file,
-                                      self.model_params.enable_local_indexing)
+        batch_size = self.model_params.training_job_batch_size
+        if batch_size > 1:
+            consumer = BatchedTrainingJobConsumer(lr_model, name=input_path)
+            results = self._pooled_action(pool, consumer, input_path, schema_params, model_weights, num_features, metadata_file,
+                                          self.model_params.enable_local_indexing, job_batch_size=batch_size)
+            results = itertools.chain.from_iterable(results)
+        else:
+            consumer = TrainingJobConsumer(lr_model, name=input_path)
+            results = self._pooled_action(pool, consumer, input_path, schema_params, model_weights, num_features, metadata_file,
+                                          self.model_params.enable_local_indexing)
         model_weights.update(results)
         logger.info(f"{len(model_weights)} models in total after training/refreshing.")
         # Dump results to model output directory.
@@ -151,7 +170,7 @@ class RandomEffectLRLBFGSModel(Model):
         batched_write_avro(itertools.chain.from_iterable(results), output_file, output_schema)
         logger.info(f"Inference complete: {input_path}.")
 
-    def _pooled_action(self, pool, consumer, input_path, schema_params, model_weights, num_features, metadata_file, gen_index_map):
+    def _pooled_action(self, pool, consumer, input_path, schema_params, model_weights, num_features, metadata_file, gen_index_map, job_batch_size=1):
         # Create training dataset
         def get_iterator():
             #  iterator and dataset should be created in the same thread to avoid TF failures.
@@ -163,11 +182,18 @@ class RandomEffectLRLBFGSModel(Model):
                 batch_size=self.model_params.batch_size,
                 data_format=self.model_params.data_format,
                 entity_name=self.model_params.partition_entity)
+            # Prefetch so reading and parsing the next batches overlaps with building jobs from the current one
+            dataset = dataset.prefetch(tf.data.experimental.AUTOTUNE)
             # Create TF iterator
             return tf.compat.v1.data.make_initializable_iterator(dataset)
 
         # Create the job generator
         jobs = prepare_jobs(get_iterator, self.model_params, schema_params, num_features=num_features, model_weights=model_weights, gen_index_map=gen_index_map)
+        if job_batch_size > 1:
+            jobs = batch_small_jobs(jobs, job_batch_size)
+        if self.model_params.use_thread_pool:
+            # Give each thread its own consumer like each process has, so no consumer state is shared between threads.
+            consumer = ThreadLocalConsumer(consumer)
         # results = map(consumer, jobs)  # Use this line instead of the next for a single process equivalent for easier dubugging
         return pool.imap_unordered(consumer, jobs, self.model_params.max_training_queue_size)
 
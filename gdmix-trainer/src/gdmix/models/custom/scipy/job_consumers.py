@@ -1,6 +1,9 @@
+import copy
 import logging
+import threading
 from collections import namedtuple
 from multiprocessing.process import current_process
+from typing import List
 
 import numpy as np
 from scipy.sparse import csr_matrix, coo_matrix
@@ -14,6 +17,12 @@ logger.setLevel(logging.INFO)
 TrainingResult = namedtuple('TrainingResult', ('theta', 'unique_global_indices'))
 Job = namedtuple('Job', 'entity_id X y offsets weights ids unique_global_indices theta')
 _CONSUMER_LOGGING_FREQUENCY = 1000
+# A warm start from the previous coordinate descent round is usually close to the optimum,
+# relax the L-BFGS precision and lower the iteration cap (never above the configured one) for those jobs.
+_WARM_START_PRECISION_FACTOR = 10
+_WARM_START_MIN_ITERATIONS = 5
+# Entities with at most this many samples are grouped into block-diagonal batches when batching is enabled.
+_MAX_BATCHED_ENTITY_SAMPLES = 512
 INDICES_SUFFIX = '_indices'
 VALUES_SUFFIX = '_values'
 
@@ -31,15 +40,57 @@ class TrainingJobConsumer:
         :param job:      training job to be processed
         :return: None
         """
-        # Train model
+        # Train model, with relaxed stopping criteria when warm starting
+        precision, max_iter = self._stopping_criteria(job.theta is not None)
         result = self.lr_model.fit(X=job.X,
                                    y=job.y,
                                    weights=job.weights,
                                    offsets=job.offsets,
-                                   theta_initial=None if job.theta is None else job.theta)
+                                   theta_initial=job.theta,
+                                   precision=precision,
+                                   max_iter=max_iter)
         inc_count(self)
         return job.entity_id, TrainingResult(result[0], job.unique_global_indices)
 
+    def _stopping_criteria(self, warm_start):
+        """
+        L-BFGS precision and iteration overrides, (None, None) keeps the settings of the LR model
+        :param warm_start: whether the job(s) start from the model of the previous round
+        :return: tuple of precision and max_iter
+        """
+        if not warm_start:
+            return None, None
+        # Never exceed the iteration cap configured on the LR model
+        max_iter = min(self.lr_model.max_iter, max(_WARM_START_MIN_ITERATIONS, self.lr_model.max_iter // 4))
+        return self.lr_model.precision * _WARM_START_PRECISION_FACTOR, max_iter
+
+
+class BatchedTrainingJobConsumer(TrainingJobConsumer):
+    """Callable class to consume batches of entity-based random effect training jobs with one solve per batch"""
+
+    def __call__(self, jobs: List[Job]):
+        """
+        Call method to process a batch of training jobs
+        :param jobs:     training jobs to be processed together
+        :return: list of (entity_id, TrainingResult)
+        """
+        if len(jobs) == 1:
+            return [super().__call__(jobs[0])]
+        # Train all models of the batch in one block-diagonal problem
+        precision, max_iter = self._stopping_criteria(all(job.theta is not None for job in jobs))
+        thetas = self.lr_model.fit_batch(Xs=[job.X for job in jobs],
+                                         ys=[job.y for job in jobs],
+                                         weights=[job.weights for job in jobs],
+                                         offsets=[job.offsets for job in jobs],
+                                         thetas_initial=[job.theta for job in jobs],
+                                         precision=precision,
+                                         max_iter=max_iter)
+        results = []
+        for job, theta in zip(jobs, thetas):
+            inc_count(self)
+            results.append((job.entity_id, TrainingResult(theta, job.unique_global_indices)))
+        return results
+
 
 class InferenceJobConsumer:
     """Callable class to consume entity-based random effect inference jobs"""
@@ -99,10 +150,50 @@ class InferenceJobConsumer:
         return self._inference_results(job.y, logits, job.weights.flatten(), job.ids.flatten(), logits_per_coordinate)
 
 
+class ThreadLocalConsumer:
+    """
+    Callable wrapper to give every thread of a thread pool its own copy of a job consumer.
+    Worker processes each unpickle their own consumer, worker threads would otherwise share one instance, including
+    its job count and the LR model whose fit() stores the learned theta.
+    """
+    def __init__(self, consumer):
+        self.consumer = consumer
+        self._local = threading.local()
+
+    def __call__(self, job):
+        consumer = getattr(self._local, 'consumer', None)
+        if consumer is None:
+            consumer = self._local.consumer = copy.deepcopy(self.consumer)
+        return consumer(job)
+
+
 def inc_count(job_consumer):
     job_consumer.job_count += 1
     if job_consumer.job_count % _CONSUMER_LOGGING_FREQUENCY == 0:
-        logger.info(f"{current_process()}: completed {job_consumer.job_count} jobs so far for {job_consumer.name}.")
+        logger.info(f"{current_process()} {threading.current_thread().name}: completed {job_consumer.job_count} jobs so far "
+                    f"for {job_consumer.name}.")
+
+
+def batch_small_jobs(jobs, batch_size, max_entity_samples=_MAX_BATCHED_ENTITY_SAMPLES):
+    """
+    Group consecutive small training jobs into batches to be solved together.
+    Jobs with more than max_entity_samples samples are emitted in a batch of their own.
+    :param jobs:                training jobs
+    :param batch_size:          maximum number of jobs in a batch
+    :param max_entity_samples:  maximum number of samples of a job to be batched with others
+    :return: generator of job lists
+    """
+    batch = []
+    for job in jobs:
+        if job.X.shape[0] > max_entity_samples:
+            yield [job]
+            continue
+        batch.append(job)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
 def prepare_jobs(batch_iterator, model_params, schema_params, num_features, model_weights: dict, gen_index_map: bool):
@@ -159,6 +250,9 @@ def prepare_jobs(batch_iterator, model_params, schema_params, num_features, mode
             else:
                 unique_global_indices = result.unique_global_indices if result else None
                 X = coo_matrix((values, (rows, cols)), shape=(sample_count, num_features))
+            # Jobs are pickled through the pool pipe, CSR carries fewer index bytes than COO
+            # (n + 1 row pointers instead of nnz row indices) and is the format the LR trainer multiplies with.
+            X = X.tocsr()
 
             # Construct y, offsets, weights and ids. Slice portion of arrays from y_index through sample_count
             y = labels_val[schema_params.label_column_name].values[y_index: y_index + sample_count]
@@ -29,7 +29,9 @@ NUM_OF_CONSUMERS = "num_of_consumers"
 NUM_OF_LBFGS_CURVATURE_PAIRS = "num_of_lbfgs_curvature_pairs"
 NUM_OF_LBFGS_ITERATIONS = "num_of_lbfgs_iterations"
 REGULARIZE_BIAS = "regularize_bias"
+TRAINING_JOB_BATCH_SIZE = "training_job_batch_size"
 TRAINING_QUEUE_TIMEOUT_IN_SECONDS = "training_queue_timeout_in_seconds"
+USE_THREAD_POOL = "use_thread_pool"
 
 AUC = "auc",
 ACCURACY = "accuracy"
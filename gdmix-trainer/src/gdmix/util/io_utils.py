@@ -1,10 +1,10 @@
 import collections
 import csv
-import itertools
-import json
+import io
 import logging
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Iterator
 
 import fastavro
@@ -17,9 +17,26 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 INTERCEPT = "(INTERCEPT)"
+_MAX_COPY_WORKERS = 32
 
+# Snappy needs the optional python-snappy package, deflate is always available in fastavro.
+try:
+    import snappy  # noqa: F401
+    DEFAULT_AVRO_CODEC = "snappy"
+except ImportError:
+    DEFAULT_AVRO_CODEC = "deflate"
 
-def try_write_avro_blocks(f, schema, records, suc_msg=None, err_msg=None):
+# orjson is an optional, faster drop-in for decoding json. Both accept str and bytes.
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# The model schema is constant, parse it once instead of on every export.
+_PARSED_BAYESIAN_LINEAR_MODEL_SCHEMA = fastavro.parse_schema(json_loads(BAYESIAN_LINEAR_MODEL_SCHEMA))
+
+
+def try_write_avro_blocks(f, schema, records, suc_msg=None, err_msg=None, codec=DEFAULT_AVRO_CODEC):
     """
     write a block into avro file. This is used continuously when the whole file does not fit in memory.
 
@@ -28,10 +45,11 @@ def try_write_avro_blocks(f, schema, records, suc_msg=None, err_msg=None):
     :param records: a set of records to be written to the avro file.
     :param suc_msg: message to print when write succeeds.
     :param err_msg: message to print when write fails.
+    :param codec: compression codec of the avro blocks, the same codec should be used when appending to a file.
     :return: none
     """
     try:
-        fastavro.writer(f, schema, records)
+        fastavro.writer(f, schema, records, codec=codec)
         if suc_msg:
             logger.info(suc_msg)
     except Exception as exp:
@@ -60,14 +78,14 @@ def load_linear_models_from_avro(model_file, feature_file):
         """
         num_features = 0 if feature_map is None else len(feature_map)
         model_coefficients = np.zeros(num_features+1, dtype=np.float64)
-        for ntv in model_record["means"]:
-            name, term, value = ntv['name'], ntv['term'], np.float64(ntv['value'])
-            if name == INTERCEPT and term == '':
-                model_coefficients[num_features] = value  # Intercept at the end.
-            elif feature_map is not None:
-                feature_index = feature_map.get((name, term), None)
-                if feature_index is not None:  # Take only the features that in the current training dataset.
-                    model_coefficients[feature_index] = value
+        means = model_record["means"]
+        values = np.fromiter((ntv['value'] for ntv in means), dtype=np.float64, count=len(means))
+        # Intercept at the end. Features not in the current training dataset get index -1 and are dropped.
+        indices = np.fromiter((num_features if ntv['name'] == INTERCEPT and ntv['term'] == ''
+                               else -1 if feature_map is None else feature_map.get((ntv['name'], ntv['term']), -1)
+                               for ntv in means), dtype=np.int64, count=len(means))
+        mask = indices >= 0
+        model_coefficients[indices[mask]] = values[mask]
         return model_coefficients
 
     if feature_file is None:
@@ -104,15 +122,12 @@ def gen_one_avro_model(model_id, model_class, weight_indices, weight_values, bia
     :param feature_list: corresponding feature names
     :return: a model in avro format
     """
-    record = {u'name': INTERCEPT, u'term': '', u'value': bias}
-    records = {u'modelId': model_id, u'modelClass': model_class, u'means': [record], u'lossFunction': ""}
+    means = [{u'name': INTERCEPT, u'term': '', u'value': bias}]
     if weight_indices is not None and weight_values is not None:
-        for w_i, w_v in zip(weight_indices.flatten(), weight_values.flatten()):
-            feat = feature_list[w_i]
-            name, term = feat[0], feat[1]
-            record = {u'name': name, u'term': term, u'value': w_v}
-            records[u'means'].append(record)
-    return records
+        # Convert to python scalars in bulk rather than boxing one numpy scalar per weight.
+        means.extend({u'name': feature_list[w_i][0], u'term': feature_list[w_i][1], u'value': w_v}
+                     for w_i, w_v in zip(np.ravel(weight_indices).tolist(), np.ravel(weight_values).tolist()))
+    return {u'modelId': model_id, u'modelClass': model_class, u'means': means, u'lossFunction': ""}
 
 
 def export_linear_model_to_avro(model_ids,
@@ -122,7 +137,8 @@ def export_linear_model_to_avro(model_ids,
                                 feature_file,
                                 output_file,
                                 model_log_interval=1000,
-                                model_class="com.linkedin.photon.ml.supervised.classification.LogisticRegressionModel"):
+                                model_class="com.linkedin.photon.ml.supervised.classification.LogisticRegressionModel",
+                                codec=DEFAULT_AVRO_CODEC):
     """
     Export random effect logistic regression model in avro format for photon-ml to consume
     :param model_ids:               a list of model ids used in generated avro file
@@ -133,6 +149,7 @@ def export_linear_model_to_avro(model_ids,
     :param output_file:             full file path for the generated avro file.
     :param model_log_interval:      write model every model_log_interval models.
     :param model_class:             the model class defined by photon-ml.
+    :param codec:                   compression codec of the avro blocks.
     :return: None
     """
     # STEP [1] - Read feature list
@@ -144,9 +161,6 @@ def export_linear_model_to_avro(model_ids,
     if feature_file:
         logger.info(f"Found {len(feature_list)} features in {feature_file}")
 
-    # STEP [3]
-    schema = fastavro.parse_schema(json.loads(BAYESIAN_LINEAR_MODEL_SCHEMA))
-
     def gen_records():
         if list_of_weight_indices is None or list_of_weight_values is None or feature_list is None:
             for i in range(num_models):
@@ -155,7 +169,7 @@ def export_linear_model_to_avro(model_ids,
             for i in range(num_models):
                 yield gen_one_avro_model(str(model_ids[i]), model_class, list_of_weight_indices[i],
                                          list_of_weight_values[i], biases[i], feature_list)
-    batched_write_avro(gen_records(), output_file, schema, model_log_interval)
+    batched_write_avro(gen_records(), output_file, _PARSED_BAYESIAN_LINEAR_MODEL_SCHEMA, model_log_interval, codec=codec)
     logger.info(f"dumped {num_models} models to avro file at {output_file}.")
 
 
@@ -166,12 +180,13 @@ def read_feature_list(feature_file):
     :param feature_file: user provided feature file, each row is a "name,term" feature name
     :return: list of feature (name, term) tuple
     """
-    result = []
+    # Read the file with a single call, iterating a GFile crosses into the C++ file system layer for every line.
     with tf.io.gfile.GFile(feature_file) as f:
-        f.seekable = lambda: False
-        for row in csv.reader(f):
-            assert len(row) == 2, f"Each feature name should have exactly name and term only, but I got {row}."
-            result.append(tuple(row))
+        content = f.read()
+    result = []
+    for row in csv.reader(io.StringIO(content)):
+        assert len(row) == 2, f"Each feature name should have exactly name and term only, but I got {row}."
+        result.append(tuple(row))
     return result
 
 
@@ -199,8 +214,8 @@ def read_json_file(file_path: str):
     if not tf.io.gfile.exists(file_path):
         raise IOError(f"Path {file_path!r} does not exist.")
     try:
-        with tf.io.gfile.GFile(file_path) as json_file:
-            return json.load(json_file)
+        with tf.io.gfile.GFile(file_path, 'rb') as json_file:
+            return json_loads(json_file.read())
     except Exception as e:
         raise ValueError(f"Failed loading file {file_path!r}.") from e
 
@@ -218,11 +233,15 @@ def copy_files(input_files, output_dir):
     if not tf.io.gfile.exists(output_dir):
         tf.io.gfile.mkdir(output_dir)
     start_time = time.time()
-    copied_files = []
-    for f in input_files:
+
+    def copy_one_file(f):
         fname = os.path.join(output_dir, os.path.basename(f))
         tf.io.gfile.copy(f, fname, overwrite=True)
-        copied_files.append(fname)
+        return fname
+
+    # Copies are dominated by I/O latency on remote file systems, run them concurrently.
+    with ThreadPoolExecutor(max_workers=max(1, min(_MAX_COPY_WORKERS, len(input_files)))) as executor:
+        copied_files = list(executor.map(copy_one_file, input_files))
     logger.info(f"Files copied to Local: {copied_files}")
     logger.info(f"--- {time.time() - start_time} seconds ---")
     return copied_files
@@ -243,44 +262,44 @@ def namedtuple_with_defaults(typename, field_names, defaults=()):
     return T
 
 
-def batched_write_avro(records: Iterator, output_file, schema, write_frequency=1000, batch_size=1024):
-    """ For the first block, the file needs to be open in âwâ mode, while the
-        rest of the blocks needs the âaâ mode. This restriction makes it
-        necessary to open the files at least twice, one for the first block,
-        one for the remaining. So itâs not possible to put them into the
-        while loop within a file context.  """
-    f = None
+def batched_write_avro(records: Iterator, output_file, schema, write_frequency=1000, batch_size=1024, codec=DEFAULT_AVRO_CODEC):
+    """
+    Stream records into an avro file through a single file handle.
+    The writer buffers the records and emits an avro block every batch_size records, so the whole file never needs to
+    fit in memory. The file is opened once and flushed once at the end, blocks are left to the file buffer in between.
+
+    :param records: an iterator of records to be written to the avro file.
+    :param output_file: full path of the avro file.
+    :param schema: avro schema used by the writer.
+    :param write_frequency: log the writing speed every write_frequency batches.
+    :param batch_size: number of records in each avro block.
+    :param codec: compression codec of the avro blocks.
+    :return: None
+    """
     t0 = time.time()
     n_batch = 0
     logger.info(f"Writing to {output_file} with batch size of {batch_size}.")
-    try:
-        for batch in _chunked_iterator(records, batch_size):
-            if n_batch == 0:
-                with tf.io.gfile.GFile(output_file, 'wb') as f0:  # Create the file in 'w' mode
-                    f0.seekable = lambda: False
-                    try_write_avro_blocks(f0, schema, batch, None, create_error_message(n_batch, output_file))
-                f = tf.io.gfile.GFile(output_file, 'ab+')  # reopen the file in 'a' mode for later writes
-                f.seekable = f.readable = lambda: True
-                f.seek(0, 2)  # seek to the end of the file, 0 is offset, 2 means the end of file
-            else:
-                try_write_avro_blocks(f, schema, batch, None, create_error_message(n_batch, output_file))
-            n_batch += 1
-            if n_batch % write_frequency == 0:
-                delta_time = time.time() - t0
-                logger.info(f"nbatch = {n_batch}, deltaT = {delta_time:0.2f} seconds, speed = {n_batch / delta_time :0.2f} batches/sec")
-        logger.info(f"Finished writing to {output_file}.")
-    finally:
-        f and f.close()
-
-
-def _chunked_iterator(iterator: Iterator, chuck_size):
-    while True:
-        chunk_it = itertools.islice(iterator, chuck_size)
+    with tf.io.gfile.GFile(output_file, 'wb') as f:
+        f.seekable = lambda: False
+        writer = fastavro.write.Writer(f, schema, codec=codec)
         try:
-            first_el = next(chunk_it)
-            yield itertools.chain((first_el,), chunk_it)
-        except StopIteration:
-            return
+            for n_records, record in enumerate(records, 1):
+                writer.write(record)
+                if n_records % batch_size == 0:
+                    # Close the avro block without flushing the file, a GFile flush is a remote sync on HDFS and GCS.
+                    # The writer may already have closed it when the block reached its sync interval.
+                    if writer.block_count > 0:
+                        writer.dump()
+                    n_batch += 1
+                    if n_batch % write_frequency == 0:
+                        delta_time = time.time() - t0
+                        logger.info(f"nbatch = {n_batch}, deltaT = {delta_time:0.2f} seconds, speed = {n_batch / delta_time :0.2f} batches/sec")
+            writer.flush()
+        except Exception as exp:
+            logger.error(exp)
+            logger.error(create_error_message(n_batch, output_file))
+            raise
+    logger.info(f"Finished writing to {output_file}.")
 
 
 def create_error_message(n_batch, output_file) -> str:
@@ -294,10 +313,12 @@ def dataset_reader(iterator):
     # https://github.com/tensorflow/tensorflow/issues/14442)
     with tf.compat.v1.Session(config=tf.compat.v1.ConfigProto(use_per_session_threads=True)) as sess:
         sess.run(iterator.initializer)
+        # Create the get_next op once, calling get_next() in the loop adds new ops to the graph for every batch.
+        next_batch = iterator.get_next()
         while True:
             try:
                 # Extract and process raw entity data
-                yield sess.run(iterator.get_next())
+                yield sess.run(next_batch)
             except tf.errors.OutOfRangeError:
                 break
 
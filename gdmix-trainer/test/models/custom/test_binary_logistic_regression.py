@@ -1,8 +1,10 @@
+import numpy as np
 import os
 import pickle
 import tensorflow as tf
 from scipy import sparse
 from sklearn.model_selection import train_test_split
+from unittest import mock
 from gdmix.models.custom.binary_logistic_regression import BinaryLogisticRegressionTrainer
 
 sample_dataset_path = os.path.join(os.getcwd(), "test/resources/custom")
@@ -11,6 +13,21 @@ os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
 _TOLERANCE = 1.0e-5
 
 
+def _random_effect_entities(num_entities, num_features=20, seed=0):
+    """
+    Generate badly scaled, nearly separable per-entity datasets of 5 to 500 samples
+    :return: tuple of the lists of feature matrices and of label vectors
+    """
+    rng = np.random.RandomState(seed)
+    Xs, ys = [], []
+    for num_samples in rng.randint(5, 501, size=num_entities):
+        X = rng.randn(num_samples, num_features) * rng.uniform(0.1, 5, num_features)
+        probabilities = 1 / (1 + np.exp(-X.dot(2 * rng.randn(num_features))))
+        Xs.append(X)
+        ys.append((rng.rand(num_samples) < probabilities).astype(np.float64))
+    return Xs, ys
+
+
 class TestBinaryLogisticRegressionTrainer(tf.test.TestCase):
     """
     Test binary logistic regression trainer
@@ -174,3 +191,82 @@ class TestBinaryLogisticRegressionTrainer(tf.test.TestCase):
         # The trained model should be far from initial value since we only train 1 step,
         # while the initial model was trained for 100 steps.
         self.assertNotAllClose(coefficients_code_start, self.custom_weights, msg='models are too close')
+
+    def test_training_with_overridden_stopping_criteria(self):
+        """
+        Precision and max_iter passed to fit override the values set at construction time.
+        """
+        coefficients = self.binary_lr_trainer.fit(X=self.x_train,
+                                                  y=self.y_train,
+                                                  weights=None,
+                                                  offsets=None,
+                                                  max_iter=1)[0]
+        coefficients_one_step = BinaryLogisticRegressionTrainer(max_iter=1).fit(X=self.x_train,
+                                                                                y=self.y_train,
+                                                                                weights=None,
+                                                                                offsets=None)[0]
+        self.assertAllClose(coefficients, coefficients_one_step, rtol=_TOLERANCE, atol=_TOLERANCE, msg='models mismatch')
+        self.assertNotAllClose(coefficients, self.custom_weights, msg='models are too close')
+
+    def test_fit_batch_matches_individual_fits(self):
+        """
+        Models trained together in one block-diagonal problem should match models trained one at a time.
+        """
+        x_train = (self.x_train - self.x_train.mean(axis=0)) / self.x_train.std(axis=0)
+        # Models of different sizes, in dense and sparse formats, one of them warm started.
+        Xs = [x_train[:60], sparse.csr_matrix(x_train[60:200]), x_train[200:, :5]]
+        ys = [self.y_train[:60], self.y_train[60:200], self.y_train[200:]]
+        for regularize_bias in (False, True):
+            # A strong regularization keeps the problem well conditioned, so both solvers stop close to the optimum.
+            binary_lr_trainer = BinaryLogisticRegressionTrainer(lambda_l2=50.0, max_iter=500, regularize_bias=regularize_bias)
+            expected = [binary_lr_trainer.fit(X=X, y=y)[0] for X, y in zip(Xs, ys)]
+            thetas_initial = [None, expected[1], None]
+            actual = binary_lr_trainer.fit_batch(Xs=Xs, ys=ys, thetas_initial=thetas_initial)
+            self.assertEqual(len(actual), len(expected))
+            for coefficients, expected_coefficients in zip(actual, expected):
+                self.assertAllClose(coefficients, expected_coefficients, rtol=1e-4, atol=1e-4, msg='models mismatch')
+
+    def test_training_with_overridden_precision(self):
+        """
+        Precision passed to fit overrides the value set at construction time.
+        """
+        loose_precision = 1e12
+        coefficients = self.binary_lr_trainer.fit(X=self.x_train,
+                                                  y=self.y_train,
+                                                  weights=None,
+                                                  offsets=None,
+                                                  precision=loose_precision)[0]
+        coefficients_loose = BinaryLogisticRegressionTrainer(precision=loose_precision, max_iter=500).fit(X=self.x_train,
+                                                                                                          y=self.y_train,
+                                                                                                          weights=None,
+                                                                                                          offsets=None)[0]
+        self.assertAllClose(coefficients, coefficients_loose, rtol=_TOLERANCE, atol=_TOLERANCE, msg='models mismatch')
+        self.assertNotAllClose(coefficients, self.custom_weights, msg='models are too close')
+
+    def test_fit_batch_at_random_effect_defaults(self):
+        """
+        With the random effect defaults, batches need more iterations than any single entity. The batched models should
+        still match the models trained one entity at a time.
+        """
+        # Random effect models use lbfgs_tolerance=1e-12, num_of_lbfgs_iterations=100 and l2_reg_weight=1.
+        binary_lr_trainer = BinaryLogisticRegressionTrainer(lambda_l2=1.0, precision=1e-12 / np.finfo(float).eps, max_iter=100)
+        for num_entities in (8, 32):
+            Xs, ys = _random_effect_entities(num_entities, seed=num_entities)
+            expected = [binary_lr_trainer.fit(X=X, y=y)[0] for X, y in zip(Xs, ys)]
+            actual = binary_lr_trainer.fit_batch(Xs=Xs, ys=ys)
+            for coefficients, expected_coefficients in zip(actual, expected):
+                self.assertAllClose(coefficients, expected_coefficients, rtol=0, atol=5e-3, msg='models mismatch')
+
+    def test_fit_batch_reports_early_stop(self):
+        """
+        A batch stopped by the iteration cap is logged, and its unconverged models are refined one at a time.
+        """
+        binary_lr_trainer = BinaryLogisticRegressionTrainer(lambda_l2=1.0, precision=1e-12 / np.finfo(float).eps, max_iter=2)
+        Xs, ys = _random_effect_entities(4)
+        with self.assertLogs('gdmix.models.custom.binary_logistic_regression', level='WARNING') as logs, \
+                mock.patch.object(binary_lr_trainer, '_minimize', wraps=binary_lr_trainer._minimize) as minimize:
+            actual = binary_lr_trainer.fit_batch(Xs=Xs, ys=ys)
+        self.assertIn('ITERATIONS REACHED LIMIT', logs.output[0])
+        self.assertEqual(minimize.call_args_list[0].args[6], 2 * len(Xs))
+        self.assertEqual(minimize.call_count, 1 + len(Xs))
+        self.assertEqual(len(actual), len(Xs))
@@ -0,0 +1,192 @@
+import numpy as np
+import tensorflow as tf
+from multiprocessing.pool import ThreadPool
+from scipy import sparse
+from unittest import mock
+
+from gdmix.models.custom.binary_logistic_regression import BinaryLogisticRegressionTrainer
+from gdmix.models.custom.scipy.job_consumers import BatchedTrainingJobConsumer, Job, ThreadLocalConsumer, TrainingJobConsumer, \
+    TrainingResult, batch_small_jobs
+
+
+def _make_job(entity_id, num_samples, num_features=4, theta=None, seed=0):
+    """
+    Create a training job with random sparse data
+    :param entity_id: entity id of the job
+    :param num_samples: number of samples of the entity
+    :param num_features: number of features, intercept excluded
+    :param theta: initial model, intercept first. None for cold start
+    :param seed: random seed
+    :return: a training Job
+    """
+    rng = np.random.RandomState(seed)
+    X = sparse.random(num_samples, num_features, density=0.5, format='csr', random_state=seed)
+    y = rng.randint(0, 2, num_samples).astype(np.float64)
+    return Job(entity_id, X, y, offsets=np.zeros(num_samples), weights=np.ones(num_samples), ids=np.arange(num_samples),
+               unique_global_indices=np.arange(num_features), theta=theta)
+
+
+class TestTrainingJobConsumer(tf.test.TestCase):
+    """
+    Test training job consumer
+    """
+
+    def test_stopping_criteria(self):
+        """
+        Cold starts keep the settings of the LR model, warm starts relax them without exceeding the iteration cap.
+        """
+        consumer = TrainingJobConsumer(BinaryLogisticRegressionTrainer(precision=10, max_iter=100), name='test')
+        self.assertEqual(consumer._stopping_criteria(warm_start=False), (None, None))
+        self.assertEqual(consumer._stopping_criteria(warm_start=True), (100, 25))
+
+        # A small iteration cap is never raised by the warm start minimum.
+        for max_iter in (1, 4, 5, 8):
+            consumer = TrainingJobConsumer(BinaryLogisticRegressionTrainer(max_iter=max_iter), name='test')
+            self.assertEqual(consumer._stopping_criteria(warm_start=True)[1], min(max_iter, 5))
+
+    def test_cold_and_warm_start_dispatch(self):
+        """
+        Cold start jobs are trained with the LR model settings, warm start jobs with the relaxed ones.
+        """
+        lr_model = BinaryLogisticRegressionTrainer(precision=10, max_iter=100)
+        consumer = TrainingJobConsumer(lr_model, name='test')
+        cold_job = _make_job('cold', 20)
+        warm_job = _make_job('warm', 20, theta=np.full(5, 0.1))
+        with mock.patch.object(lr_model, 'fit', wraps=lr_model.fit) as fit:
+            entity_id, result = consumer(cold_job)
+            self.assertEqual(entity_id, 'cold')
+            self.assertIsInstance(result, TrainingResult)
+            self.assertAllEqual(result.unique_global_indices, cold_job.unique_global_indices)
+            _, kwargs = fit.call_args
+            self.assertIsNone(kwargs['theta_initial'])
+            self.assertIsNone(kwargs['precision'])
+            self.assertIsNone(kwargs['max_iter'])
+
+            entity_id, result = consumer(warm_job)
+            self.assertEqual(entity_id, 'warm')
+            _, kwargs = fit.call_args
+            self.assertAllEqual(kwargs['theta_initial'], warm_job.theta)
+            self.assertEqual(kwargs['precision'], 100)
+            self.assertEqual(kwargs['max_iter'], 25)
+        self.assertEqual(consumer.job_count, 2)
+
+
+class TestBatchSmallJobs(tf.test.TestCase):
+    """
+    Test grouping of small training jobs
+    """
+
+    def test_grouping(self):
+        """
+        Small jobs are grouped up to the batch size, the trailing partial batch is emitted at the end.
+        """
+        jobs = [_make_job(str(i), 10, seed=i) for i in range(5)]
+        batches = list(batch_small_jobs(iter(jobs), batch_size=2))
+        self.assertEqual([[job.entity_id for job in batch] for batch in batches], [['0', '1'], ['2', '3'], ['4']])
+
+    def test_large_jobs_are_not_batched(self):
+        """
+        Jobs with more samples than the limit get a batch of their own without breaking up the pending small batch.
+        """
+        jobs = [_make_job('small_0', 10), _make_job('large', 513), _make_job('small_1', 512), _make_job('small_2', 1)]
+        batches = list(batch_small_jobs(iter(jobs), batch_size=2))
+        self.assertEqual([[job.entity_id for job in batch] for batch in batches], [['large'], ['small_0', 'small_1'], ['small_2']])
+
+        batches = list(batch_small_jobs(iter(jobs), batch_size=3, max_entity_samples=10))
+        self.assertEqual([[job.entity_id for job in batch] for batch in batches], [['large'], ['small_1'], ['small_0', 'small_2']])
+
+    def test_no_jobs(self):
+        self.assertEqual(list(batch_small_jobs(iter([]), batch_size=2)), [])
+
+
+class TestBatchedTrainingJobConsumer(tf.test.TestCase):
+    """
+    Test batched training job consumer
+    """
+
+    def test_one_result_per_job(self):
+        """
+        A batch yields one (entity_id, TrainingResult) per job, matching the models trained one job at a time.
+        """
+        jobs = [_make_job('0', 30, seed=0), _make_job('1', 20, num_features=3, seed=1), _make_job('2', 40, theta=np.full(5, 0.1), seed=2)]
+        lr_model = BinaryLogisticRegressionTrainer(lambda_l2=1.0, max_iter=500)
+        batched_consumer = BatchedTrainingJobConsumer(lr_model, name='test')
+        results = batched_consumer(jobs)
+        self.assertEqual(batched_consumer.job_count, len(jobs))
+        self.assertEqual([entity_id for entity_id, _ in results], ['0', '1', '2'])
+
+        # Warm start settings differ between a partially and a fully warm batch, train each job cold for the comparison.
+        consumer = TrainingJobConsumer(BinaryLogisticRegressionTrainer(lambda_l2=1.0, max_iter=500), name='test')
+        for job, (_, result) in zip(jobs, results):
+            self.assertIsInstance(result, TrainingResult)
+            self.assertAllEqual(result.unique_global_indices, job.unique_global_indices)
+            _, expected = consumer(job._replace(theta=None))
+            self.assertAllClose(result.theta, expected.theta, rtol=1e-4, atol=1e-4, msg='models mismatch')
+
+    def test_warm_batch_at_random_effect_defaults(self):
+        """
+        A warm started batch at the random effect defaults converges to the models trained one job at a time.
+        """
+        def random_effect_lr_model():
+            # Random effect models use lbfgs_tolerance=1e-12, num_of_lbfgs_iterations=100 and l2_reg_weight=1.
+            return BinaryLogisticRegressionTrainer(lambda_l2=1.0, precision=1e-12 / np.finfo(float).eps, max_iter=100)
+
+        rng = np.random.RandomState(0)
+        consumer = TrainingJobConsumer(random_effect_lr_model(), name='test')
+        jobs, expected = [], []
+        for i, num_samples in enumerate(rng.randint(5, 501, size=16)):
+            X = rng.randn(num_samples, 20) * rng.uniform(0.1, 5, 20)
+            y = (rng.rand(num_samples) < 1 / (1 + np.exp(-X.dot(2 * rng.randn(20))))).astype(np.float64)
+            job = Job(str(i), X, y, offsets=np.zeros(num_samples), weights=np.ones(num_samples), ids=np.arange(num_samples),
+                      unique_global_indices=np.arange(20), theta=None)
+            _, result = consumer(job)
+            expected.append(result.theta)
+            # Warm start close to the model, as in a later round of coordinate descent.
+            jobs.append(job._replace(theta=result.theta + 0.1 * rng.randn(21)))
+
+        results = BatchedTrainingJobConsumer(random_effect_lr_model(), name='test')(jobs)
+        for (_, result), expected_theta in zip(results, expected):
+            self.assertAllClose(result.theta, expected_theta, rtol=0, atol=5e-3, msg='models mismatch')
+
+    def test_single_job_batch(self):
+        """
+        A batch with a single job is trained with fit() as in the unbatched consumer.
+        """
+        job = _make_job('0', 30)
+        lr_model = BinaryLogisticRegressionTrainer()
+        consumer = BatchedTrainingJobConsumer(lr_model, name='test')
+        with mock.patch.object(lr_model, 'fit', wraps=lr_model.fit) as fit, \
+                mock.patch.object(lr_model, 'fit_batch', wraps=lr_model.fit_batch) as fit_batch:
+            results = consumer([job])
+        fit.assert_called_once()
+        fit_batch.assert_not_called()
+        self.assertEqual(len(results), 1)
+        entity_id, result = results[0]
+        self.assertEqual(entity_id, '0')
+        _, expected = TrainingJobConsumer(BinaryLogisticRegressionTrainer(), name='test')(job)
+        self.assertAllEqual(result.theta, expected.theta)
+        self.assertEqual(consumer.job_count, 1)
+
+
+class TestThreadLocalConsumer(tf.test.TestCase):
+    """
+    Test per-thread job consumers
+    """
+
+    def test_each_thread_has_its_own_consumer(self):
+        """
+        Threads train with their own copy of the consumer and LR model, the wrapped consumer is left untouched.
+        """
+        lr_model = BinaryLogisticRegressionTrainer()
+        consumer = TrainingJobConsumer(lr_model, name='test')
+        thread_local_consumer = ThreadLocalConsumer(consumer)
+        jobs = [_make_job(str(i), 20, seed=i) for i in range(8)]
+        with ThreadPool(2) as pool:
+            results = dict(pool.imap_unordered(thread_local_consumer, jobs, 1))
+
+        self.assertEqual(consumer.job_count, 0)
+        self.assertIsNone(lr_model.theta)
+        expected_consumer = TrainingJobConsumer(BinaryLogisticRegressionTrainer(), name='test')
+        for job in jobs:
+            _, expected = expected_consumer(job)
+            self.assertAllEqual(results[job.entity_id].theta, expected.theta)
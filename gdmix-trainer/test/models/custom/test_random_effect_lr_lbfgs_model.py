@@ -130,6 +130,76 @@ class TestRandomEffectCustomLRModel(tf.test.TestCase):
         tf.io.gfile.rmtree(checkpoint_dir)
         tf.io.gfile.rmtree(predict_output_dir)
 
+    def _train_models(self, extra_params):
+        """
+        Train random effect models on the test dataset and read them back.
+        :param extra_params: additional raw parameters
+        :return: a dictionary of {entity: TrainingResult}.
+        """
+        base_training_params, raw_params = self.get_raw_params()
+        avro_model_output_dir = tempfile.mkdtemp()
+        raw_params.extend(['--' + constants.OUTPUT_MODEL_DIR, avro_model_output_dir])
+        raw_params.extend(extra_params)
+        re_lr_model = RandomEffectLRLBFGSModel(raw_model_params=raw_params)
+
+        checkpoint_dir = tempfile.mkdtemp()
+        training_context = {constants.PARTITION_INDEX: 0}
+        re_lr_model.train(training_data_dir=test_dataset_path, validation_data_dir=test_dataset_path,
+                          metadata_file=os.path.join(test_dataset_path, "data.json"), checkpoint_path=checkpoint_dir,
+                          execution_context=training_context, schema_params=setup_fake_schema_params())
+        models = re_lr_model._load_weights(os.path.join(avro_model_output_dir, f"part-{0:05d}.avro"))
+
+        # remove the temp dir(s).
+        tf.io.gfile.rmtree(avro_model_output_dir)
+        tf.io.gfile.rmtree(checkpoint_dir)
+        return models
+
+    def test_train_with_job_batching(self):
+        """
+        Training small entities together in block-diagonal batches should produce the same models as one by one.
+        """
+        models = self._train_models([])
+        batched_models = self._train_models(['--' + constants.TRAINING_JOB_BATCH_SIZE, '2'])
+        self.assertEqual(models.keys(), batched_models.keys())
+        for model_id in models:
+            self.assertAllClose(batched_models[model_id].theta, models[model_id].theta,
+                                rtol=1e-4, atol=1e-4, msg='models mismatch')
+            self.assertAllEqual(batched_models[model_id].unique_global_indices, models[model_id].unique_global_indices)
+
+    def test_train_and_predict_with_thread_pool(self):
+        """
+        Consumers running on a thread pool should train the same models and produce the same scores as on processes.
+        """
+        models = self._train_models([])
+        thread_pool_params = ['--' + constants.USE_THREAD_POOL, 'True']
+        thread_pool_models = self._train_models(thread_pool_params)
+        self.assertEqual(models.keys(), thread_pool_models.keys())
+        for model_id in models:
+            self.assertAllClose(thread_pool_models[model_id].theta, models[model_id].theta, msg='models mismatch')
+
+        # Predict with the same model on processes and on threads.
+        base_training_params, raw_params = self.get_raw_params()
+        avro_model_output_dir = tempfile.mkdtemp()
+        raw_params.extend(['--' + constants.OUTPUT_MODEL_DIR, avro_model_output_dir])
+        RandomEffectLRLBFGSModel(raw_model_params=raw_params).train(
+            training_data_dir=test_dataset_path, validation_data_dir=test_dataset_path,
+            metadata_file=os.path.join(test_dataset_path, "data.json"), checkpoint_path=tempfile.mkdtemp(),
+            execution_context={constants.PARTITION_INDEX: 0}, schema_params=setup_fake_schema_params())
+        predictions = []
+        for extra_params in ([], thread_pool_params):
+            re_lr_model = RandomEffectLRLBFGSModel(raw_model_params=raw_params + extra_params)
+            predict_output_dir = tempfile.mkdtemp()
+            re_lr_model.predict(output_dir=predict_output_dir, input_data_path=test_dataset_path,
+                                metadata_file=os.path.join(test_dataset_path, "data.json"),
+                                checkpoint_path=avro_model_output_dir,
+                                execution_context={constants.PARTITION_INDEX: 0}, schema_params=setup_fake_schema_params())
+            with open(os.path.join(predict_output_dir, f"part-{0:05d}.avro"), 'rb') as fo:
+                predictions.append(sorted((record for record in reader(fo)), key=lambda record: record['uid']))
+            tf.io.gfile.rmtree(predict_output_dir)
+        self.assertTrue(predictions[0])
+        self.assertEqual(predictions[0], predictions[1])
+        tf.io.gfile.rmtree(avro_model_output_dir)
+
     def _check_intercept_only_model(self, models):
         """
         Check the intercept only model.
@@ -1,10 +1,12 @@
 import csv
+import fastavro
 import numpy as np
 import os
 import tempfile
 import tensorflow as tf
+from unittest import mock
 
-from gdmix.util.io_utils import export_linear_model_to_avro, get_feature_map, gen_one_avro_model,\
+from gdmix.util.io_utils import DEFAULT_AVRO_CODEC, batched_write_avro, export_linear_model_to_avro, get_feature_map, gen_one_avro_model,\
     load_linear_models_from_avro, read_feature_list
 
 
@@ -63,6 +65,21 @@ class TestIoUtils(tf.test.TestCase):
         for i in range(len(short_models)):
             self.assertAllEqual(short_models[i], self.expected_short_models[i])
 
+    def testExportModelCodec(self):
+        with open(self.model_file, 'rb') as fo:
+            self.assertEqual(fastavro.reader(fo).codec, DEFAULT_AVRO_CODEC)
+        uncompressed_model_file = os.path.join(self.base_dir, 'uncompressed_model.avro')
+        export_linear_model_to_avro(model_ids=["model 1", "model 2"],
+                                    list_of_weight_indices=self.weight_indices,
+                                    list_of_weight_values=self.weight_values,
+                                    biases=self.biases,
+                                    feature_file=self.feature_file,
+                                    output_file=uncompressed_model_file,
+                                    codec='null')
+        models = load_linear_models_from_avro(uncompressed_model_file, self.feature_file)
+        for model, expected in zip(models, self.expected_models):
+            self.assertAllEqual(model, expected)
+
     def testGenOneAvroModel(self):
         """
         Test avro model generation.
@@ -83,3 +100,34 @@ class TestIoUtils(tf.test.TestCase):
             {u'name': 'f3', u'term': 't3,3', u'value': 5.6}
         ], u'lossFunction': ""}
         self.assertDictEqual(records_avro, records)
+
+    def testBatchedWriteAvro(self):
+        """
+        Test batched avro writing with a partial last batch, an exact multiple of the batch size and no records.
+        :return: None
+        """
+        schema = fastavro.parse_schema({'name': 'record', 'type': 'record', 'fields': [{'name': 'uid', 'type': 'long'}]})
+        for num_records, expected_block_sizes in ((10, [3, 3, 3, 1]), (9, [3, 3, 3]), (0, [])):
+            output_file = os.path.join(self.base_dir, f'batched_{num_records}.avro')
+            records = [{'uid': i} for i in range(num_records)]
+            batched_write_avro(iter(records), output_file, schema, batch_size=3)
+            self.assertTrue(os.path.exists(output_file))
+            with open(output_file, 'rb') as fo:
+                avro_reader = fastavro.reader(fo)
+                self.assertEqual(avro_reader.codec, DEFAULT_AVRO_CODEC)
+                self.assertEqual(list(avro_reader), records)
+            with open(output_file, 'rb') as fo:
+                self.assertEqual([block.num_records for block in fastavro.block_reader(fo)], expected_block_sizes)
+
+    def testBatchedWriteAvroFlushesOnce(self):
+        """
+        Test the output file is flushed once at the end rather than once per batch.
+        :return: None
+        """
+        schema = fastavro.parse_schema({'name': 'record', 'type': 'record', 'fields': [{'name': 'uid', 'type': 'long'}]})
+        output_file = os.path.join(self.base_dir, 'flushed_once.avro')
+        with mock.patch.object(tf.io.gfile.GFile, 'flush', autospec=True, side_effect=tf.io.gfile.GFile.flush) as flush:
+            batched_write_avro(iter({'uid': i} for i in range(10)), output_file, schema, batch_size=3)
+        self.assertEqual(flush.call_count, 1)
+        with open(output_file, 'rb') as fo:
+            self.assertEqual([block.num_records for block in fastavro.block_reader(fo)], [3, 3, 3, 1])